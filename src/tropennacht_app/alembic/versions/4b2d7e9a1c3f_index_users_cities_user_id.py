@@ -0,0 +1,32 @@
+"""index users_cities.user_id
+
+Revision ID: 4b2d7e9a1c3f
+Revises: 95f9b71fa6cb
+Create Date: 2026-10-15 09:12:44.105327
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "4b2d7e9a1c3f"
+down_revision: Union[str, None] = "95f9b71fa6cb"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        "ix_users_cities_user_id",
+        "users_cities",
+        ["user_id"],
+        unique=False,
+        schema="public",
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_users_cities_user_id", table_name="users_cities", schema="public")
@@ -0,0 +1,57 @@
+"""covering index on users_cities (user_id, id)
+
+Revision ID: 8f3a6c1d5e27
+Revises: 4b2d7e9a1c3f
+Create Date: 2026-10-15 14:37:51.662093
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "8f3a6c1d5e27"
+down_revision: Union[str, None] = "4b2d7e9a1c3f"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # CONCURRENTLY can't run inside a transaction, but doesn't block writes
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_users_cities_user_id_id",
+            "users_cities",
+            ["user_id", "id"],
+            unique=False,
+            schema="public",
+            postgresql_include=["city"],
+            postgresql_concurrently=True,
+        )
+        # Superseded by the new index, which has user_id as its leading column
+        op.drop_index(
+            "ix_users_cities_user_id",
+            table_name="users_cities",
+            schema="public",
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_users_cities_user_id",
+            "users_cities",
+            ["user_id"],
+            unique=False,
+            schema="public",
+            postgresql_concurrently=True,
+        )
+        op.drop_index(
+            "ix_users_cities_user_id_id",
+            table_name="users_cities",
+            schema="public",
+            postgresql_concurrently=True,
+        )
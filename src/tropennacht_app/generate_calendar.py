@@ -1,21 +1,107 @@
+import contextlib
+import fcntl
 import os
-from datetime import datetime, timedelta
+import tempfile
+import threading
+import time
+import zlib
+from datetime import date, datetime
 
-import pandas as pd
-import plotly_calplot
-import vcr
 from cachetools import TTLCache, cached
-from meteostat import Hourly, Point
 
-# Function to generate tropical nights plot for a given city
+# Rendered plots are written below the static directory, so they are shared
+# between worker processes and served as plain files
+PLOT_DIR = os.path.join(os.path.dirname(__file__), "static", "plots")
+PLOT_URL = "/static/plots"
+
+# Renders are serialized through a fixed set of lock files outside the static
+# directory, so they are never served and never need cleaning up
+LOCK_DIR = os.path.join(tempfile.gettempdir(), "tropennacht_plot_locks")
+LOCK_STRIPES = 64
+
+# Rendered plots older than this (in seconds) are swept from the disk cache
+CACHE_MAX_AGE = 60 * 60 * 24 * 2
 
 # Define a cache with a max size and time-to-live duration (in seconds)
 
 cache = TTLCache(maxsize=float("inf"), ttl=60 * 60 * 24)
 
 
-@cached(cache)
+def _plot_filename(lat, lon, day: date) -> str:
+    return f"{lat:.4f}_{lon:.4f}_{day:%Y%m%d}.png"
+
+
+def _lock_path(filename: str) -> str:
+    # crc32 is stable across processes, unlike hash() of a str
+    return os.path.join(
+        LOCK_DIR, f"{zlib.crc32(filename.encode()) % LOCK_STRIPES}.lock"
+    )
+
+
+def _sweep_cache() -> None:
+    """
+    Delete rendered plots older than CACHE_MAX_AGE
+    """
+
+    cutoff = time.time() - CACHE_MAX_AGE
+    for entry in os.scandir(PLOT_DIR):
+        if (
+            entry.name.endswith(".png")
+            and entry.is_file()
+            and entry.stat().st_mtime < cutoff
+        ):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(entry.path)
+
+
+# The lock guards the cache itself, as the plot is generated from worker threads
+@cached(cache, lock=threading.Lock())
 def generate_tropical_nights_plot(lat, lon):
+    """
+    Get the URL of the tropical nights plot for a location, rendering it at most
+    once per day
+
+    The in-memory cache sits in front of the PNG files on disk, which are keyed
+    by location and date, shared by all workers and survive restarts. A file
+    lock makes concurrent misses wait for a single render instead of repeating
+    it.
+    """
+
+    os.makedirs(PLOT_DIR, exist_ok=True)
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    filename = _plot_filename(lat, lon, date.today())
+    path = os.path.join(PLOT_DIR, filename)
+
+    with open(_lock_path(filename), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        if not os.path.exists(path):
+            plot_png = _render_tropical_nights_plot(lat, lon)
+
+            # Write to a temporary file first so readers never see a partial plot
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(plot_png)
+            os.replace(tmp_path, path)
+
+            _sweep_cache()
+
+    return f"{PLOT_URL}/{filename}"
+
+
+def _weather_api_cassette():
+    """
+    Record and replay weather API traffic when running tests
+
+    Outside of tests Meteostat is called directly; it keeps the fetched data in
+    its own on-disk cache (refreshed after a day), so no cassette is needed.
+    """
+
+    if os.getenv("ENV") != "test":
+        return contextlib.nullcontext()
+
+    import vcr
+
     current_dir = os.path.dirname(__file__)
     cassette_path = os.path.join(current_dir, "vcr_weather_api.yaml")
 
@@ -23,8 +109,18 @@ def generate_tropical_nights_plot(lat, lon):
         record_mode="new_episodes",  # This mode allows recording new interactions if no match is found
         cassette_library_dir=cassette_path,  # Directory where cassettes will be saved
     )
+    return my_vcr.use_cassette(cassette_path)
+
 
-    with my_vcr.use_cassette(cassette_path):
+# Function to generate tropical nights plot for a given city
+def _render_tropical_nights_plot(lat, lon):
+    # The pandas/plotly/meteostat stack is only needed on a cache miss, so keep it
+    # out of the import of the web app
+    import pandas as pd
+    import plotly_calplot
+    from meteostat import Hourly, Point
+
+    with _weather_api_cassette():
         # Define location and time range
 
         city = Point(lat, lon)
@@ -33,40 +129,40 @@ def generate_tropical_nights_plot(lat, lon):
         )
         end = datetime(datetime.now().year, datetime.now().month, datetime.now().day)
 
-        # Fetch weather data
-        data = Hourly(city, start, end).fetch()
-
-        # Function to check if it's a tropical night
-        def is_tropical_night(df, date):
-            """Check if the given date is a tropical night (temperature never drops below 20°C)."""
-            day_data = df.loc[date]
-            return day_data["temp"].min() >= 20
+        # Fetch weather data, keeping only the temperature (0.1°C precision, so
+        # float32 is exact enough for the 20°C threshold)
+        temp = Hourly(city, start, end).fetch()["temp"].astype("float32")
 
-        # Collect results
-        results = []
+        # A night is tropical if the temperature never drops below 20°C that day
+        daily_min = temp.resample("D").min()
         date_range = pd.date_range(start=start, end=end, freq="D")
-
-        for date in date_range:
-            start_of_day = date
-            end_of_day = date + timedelta(days=1)
-            Hourly_data = data.loc[start_of_day:end_of_day]
-            tropical_night = is_tropical_night(Hourly_data, start_of_day)
-            results.append({"date": start_of_day, "tropical_night": tropical_night})
-
-        results_df = pd.DataFrame(results)
-        results_df["value"] = results_df["tropical_night"].astype(int)
+        tropical_nights = daily_min.ge(20).reindex(date_range, fill_value=False)
 
         # Add a column 'value' where 1 represents a tropical night, 0 otherwise
-        results_df["value"] = results_df["tropical_night"].astype(int)
+        results_df = pd.DataFrame(
+            {"date": date_range, "value": tropical_nights.astype(int).to_numpy()}
+        )
 
         # Summarize tropical nights by year
-        results_df["year"] = results_df["date"].dt.year
-        annual_summary = results_df.groupby("year")["value"].sum().reset_index()
+        annual_summary = (
+            results_df.groupby(results_df["date"].dt.year)["value"].sum().reset_index()
+        )
         annual_summary.columns = ["year", "tropical_nights"]
 
+        # Build the summary table directly instead of going through DataFrame.to_html
+        summary_table = (
+            "<table><tr><th>Year</th><th>Tropical Nights</th></tr>"
+            + "".join(
+                f"<tr><td>{year}</td><td>{nights}</td></tr>"
+                for year, nights in zip(
+                    annual_summary["year"], annual_summary["tropical_nights"]
+                )
+            )
+            + "</table>"
+        )
+
         # Prepare data for visualization
-        data = pd.DataFrame({"date": results_df["date"], "value": results_df["value"]})
-        fig = plotly_calplot.calplot(data, x="date", y="value")
+        fig = plotly_calplot.calplot(results_df, x="date", y="value")
 
         # Update plot layout
         fig.update_layout(
@@ -80,7 +176,7 @@ def generate_tropical_nights_plot(lat, lon):
                     y=-0.1,
                     xref="paper",
                     yref="paper",
-                    text=f"Total Tropical Nights by Year:<br>{annual_summary.to_html(index=False)}",
+                    text=f"Total Tropical Nights by Year:<br>{summary_table}",
                     showarrow=False,
                     font=dict(size=12),
                     align="center",
@@ -104,7 +200,6 @@ def generate_tropical_nights_plot(lat, lon):
                 align="center",
             )
 
-        # Generate plot HTML
-        plot_html = fig.to_html(full_html=False)
-        # plot_html = None
-        return plot_html
+        # Render the plot as a static image; its height is set by calplot per year
+        plot_png = fig.to_image(format="png", width=900)
+        return plot_png
@@ -1,12 +1,23 @@
+import logging
 import os
 import uuid
+from contextlib import asynccontextmanager
+from functools import cache, lru_cache
 
-from sqlalchemy import Column, String, create_engine
+from cachetools import TTLCache
+from sqlalchemy import Column, Index, String, delete, insert, select
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from uuid_utils.compat import uuid7
 
 from sqlalchemy.dialects.postgresql import UUID  # for PostgreSQL UUID support
 
+log = logging.getLogger(__name__)
 
 DB_CONNECTION_STRING = os.getenv("DB_CONNECTION_STRING")
 
@@ -15,108 +26,306 @@ if not DB_CONNECTION_STRING:
         "The environment variable DB_CONNECTION_STRING is not set. Please set it before running the application."
     )
 
+STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "500"))
+
 # Define SQLAlchemy base model
 Base = declarative_base()
 
 
-# Create an engine
-engine = create_engine(DB_CONNECTION_STRING)
+# The engine and session factory are created on first use, so importing this
+# module doesn't open any connection. Pooled connections must not be shared
+# with a forked child (e.g. gunicorn with preload_app), so both are dropped in
+# the child after a fork and recreated there.
+@cache
+def get_engine() -> AsyncEngine:
+    """
+    Get the engine of the current process, creating it on first use
+    """
+
+    # Keep prepared statements per connection, so repeated queries skip the
+    # server-side parse/plan. Behind a transaction-mode pooler (e.g. pgbouncer
+    # or Supabase's pooler), which can't keep them, set DB_STATEMENT_CACHE_SIZE=0;
+    # statements are then also given unique names, since one client connection
+    # may reach several server connections and fixed names would collide there.
+    connect_args = {
+        "prepared_statement_cache_size": STATEMENT_CACHE_SIZE,
+        "statement_cache_size": STATEMENT_CACHE_SIZE,
+    }
+    if not STATEMENT_CACHE_SIZE:
+        connect_args["prepared_statement_name_func"] = lambda: (
+            f"__asyncpg_{uuid.uuid4()}__"
+        )
+
+    # Create an async engine on the asyncpg driver, so queries don't block the
+    # event loop; pooled connections are reused across requests. LIFO
+    # checkout keeps reusing the most recently used connections so the
+    # surplus ones go idle and get recycled instead of all being kept warm.
+    return create_async_engine(
+        DB_CONNECTION_STRING.replace("postgresql://", "postgresql+asyncpg://", 1),
+        pool_size=int(os.getenv("DB_POOL_SIZE", "10")),
+        max_overflow=int(os.getenv("DB_POOL_OVERFLOW", "20")),
+        pool_timeout=30,
+        pool_recycle=1800,
+        pool_pre_ping=True,
+        pool_use_lifo=True,
+        connect_args=connect_args,
+    )
+
+
+@cache
+def get_sessionmaker() -> async_sessionmaker[AsyncSession]:
+    """
+    Get the session factory of the current process, bound to its engine
 
-# Create a configured "Session" class
-Session = sessionmaker(bind=engine)
+    Each call below opens its own short-lived session, which returns its
+    connection to the pool when the block exits.
+    """
 
-# Create a session
-session = Session()
+    return async_sessionmaker(bind=get_engine(), expire_on_commit=False)
+
+
+def _reset_after_fork():
+    # Drop the pool inherited from the parent without closing its connections,
+    # which still belong to the parent, then let the child build its own engine
+    if get_engine.cache_info().currsize:
+        get_engine().sync_engine.dispose(close=False)
+    get_sessionmaker.cache_clear()
+    get_engine.cache_clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
 
 
 # Define table models
 class UsersCities(Base):
     __tablename__ = "users_cities"
-    __table_args__ = {"schema": "public"}
+    __table_args__ = (
+        # All lookups filter by user_id (and delete also by id); including city
+        # lets get_cities_for_user be answered by an index-only scan
+        Index(
+            "ix_users_cities_user_id_id",
+            "user_id",
+            "id",
+            postgresql_include=["city"],
+        ),
+        {"schema": "public"},
+    )
 
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    # Time-ordered ids keep primary key inserts on the right-most index page.
+    # Ids are only ever passed around as text (URLs, form fields), so they are
+    # kept as strings rather than converted to uuid.UUID objects and back.
+    id = Column(UUID(as_uuid=False), primary_key=True, default=lambda: str(uuid7()))
     user_id = Column(UUID(as_uuid=True), nullable=False)
     city = Column(String(254))
 
 
-# Function to add a new row
-def add_user_city(user_id: str, city: str):
+# Cache each user's city list for a short while, keyed by the user id string.
+# Writes through this module invalidate the user's entry right away; the TTL
+# bounds staleness for writes made by other worker processes.
+cities_cache = TTLCache(maxsize=10_000, ttl=60)
+
+# Number of invalidations so far, across all users. get_cities_for_user awaits
+# the query between its cache miss and storing the result; if any write
+# invalidated an entry meanwhile, the generation has moved on and the (possibly
+# stale) result is returned without being cached. Writes are rare next to
+# reads, so the occasional skipped store for another user costs little.
+cities_cache_generation = 0
+
+
+def _invalidate_cities(user_key: str):
+    global cities_cache_generation
+    cities_cache.pop(user_key, None)
+    cities_cache_generation += 1
+
+
+# Parse a UUID string, reusing the result for ids we have already seen; raises
+# ValueError for invalid strings and TypeError for non-strings such as a missing
+# form field (errors are not cached)
+@lru_cache(maxsize=4096)
+def _as_uuid(value: str) -> uuid.UUID:
+    return uuid.UUID(value)
+
+
+class _Txn:
+    """
+    A session transaction opened by _txn
+
+    committed is only set once the transaction has been committed, so values
+    read inside the block must not be used unless it is set after the block.
+    """
+
+    def __init__(self, session: AsyncSession):
+        self.session = session
+        self.committed = False
+
+
+@asynccontextmanager
+async def _txn(error_message: str, *args):
+    """
+    Run the block in a session transaction, committing on success
+
+    On error, including one raised by the commit itself, the transaction is
+    rolled back and the error is logged with the given message instead of
+    raised; the caller checks the yielded transaction's committed flag.
+    """
+
+    async with get_sessionmaker()() as session:
+        txn = _Txn(session)
+        try:
+            async with session.begin():
+                yield txn
+            txn.committed = True
+        except Exception:
+            log.exception(error_message, *args)
+
+
+# Function to add a new row, returning its id (None if it wasn't added)
+async def add_user_city(user_id: str | uuid.UUID, city: str) -> str | None:
     try:
-        # Ensure user_id is a valid UUID
-        user_id = uuid.UUID(user_id)
-
-        # Create a new UsersCities instance
-        new_entry = UsersCities(user_id=user_id, city=city)
-        # Add the entry to the session
-        session.add(new_entry)
-        # Commit the session to persist the changes
-        session.commit()
-        print(f"Added user {user_id} with city {city}")
-    except ValueError:
-        print(f"Invalid UUID: {user_id}")
-    except Exception as e:
-        session.rollback()
-        print(f"Error adding user city: {e}")
-    finally:
-        session.close()
+        # Ensure user_id is a valid UUID; callers may pass one already parsed
+        uid = user_id if isinstance(user_id, uuid.UUID) else _as_uuid(user_id)
+    except (ValueError, TypeError):
+        log.warning("Invalid UUID: %s", user_id)
+        return None
+
+    async with _txn("Error adding user city") as txn:
+        # Insert the row directly, without tracking an ORM instance; the new
+        # id comes back in the same round trip
+        result = await txn.session.execute(
+            insert(UsersCities).values(user_id=uid, city=city).returning(UsersCities.id)
+        )
+        city_id = result.scalar_one()
+
+    if not txn.committed:
+        return None
+
+    _invalidate_cities(str(uid))
+    log.debug("Added user %s with city %s", uid, city)
+    return city_id
+
+
+# Function to add several rows in one round trip
+async def add_user_cities(rows: list[tuple[str, str]]):
+    try:
+        # Ensure every user_id is a valid UUID before inserting anything
+        payload = [
+            {"user_id": _as_uuid(user_id), "city": city} for user_id, city in rows
+        ]
+    except (ValueError, TypeError):
+        log.warning("Invalid UUID in rows: %s", rows)
+        return
+
+    if not payload:
+        return
+
+    async with _txn("Error adding user cities") as txn:
+        # A list of parameter sets is sent as batched multi-row INSERTs
+        await txn.session.execute(insert(UsersCities), payload)
+
+    if not txn.committed:
+        return
+
+    for user_id in {str(row["user_id"]) for row in payload}:
+        _invalidate_cities(user_id)
+    log.debug("Added %d user cities", len(payload))
 
 
 # Function to delete a row by id and user_id (to ensure user ownership)
-def delete_user_city_by_id(user_id: str, city_id: str):
+async def delete_user_city_by_id(user_id: str, city_id: str):
     try:
-        # Ensure both user_id and city_id are valid UUIDs
-        user_id = uuid.UUID(user_id)
-        city_id = uuid.UUID(city_id)
+        # Ensure both user_id and city_id are valid UUIDs; the id column takes
+        # its canonical string form
+        user_id = _as_uuid(user_id)
+        city_id = str(_as_uuid(city_id))
+    except (ValueError, TypeError):
+        log.warning("Invalid UUID: %s or %s", user_id, city_id)
+        return
 
-        # Query for the entry with the given city_id and user_id
-        entry_to_delete = (
-            session.query(UsersCities).filter_by(id=city_id, user_id=user_id).first()
+    async with _txn("Error deleting city") as txn:
+        # Delete the entry with the given city_id and user_id in one statement
+        result = await txn.session.execute(
+            delete(UsersCities).where(
+                UsersCities.id == city_id, UsersCities.user_id == user_id
+            )
         )
 
-        if entry_to_delete:
-            # Delete the entry from the session
-            session.delete(entry_to_delete)
-            # Commit the session to persist the changes
-            session.commit()
-            print(f"Deleted city with ID {city_id} for user {user_id}")
-        else:
-            print(f"No entry found for user {user_id} with city ID {city_id}")
-    except ValueError:
-        print(f"Invalid UUID: {user_id} or {city_id}")
-    except Exception as e:
-        session.rollback()
-        print(f"Error deleting city: {e}")
-    finally:
-        session.close()
+    if not txn.committed:
+        return
+
+    _invalidate_cities(str(user_id))
+    if result.rowcount:
+        log.debug("Deleted city with ID %s for user %s", city_id, user_id)
+    else:
+        log.info("No entry found for user %s with city ID %s", user_id, city_id)
 
 
 # Function to get all cities (id and name) for a user
-def get_cities_for_user(user_id: str):
+async def get_cities_for_user(user_id: str):
     try:
         # Ensure user_id is a valid UUID
-        user_id = uuid.UUID(user_id)
+        user_id = _as_uuid(user_id)
+    except (ValueError, TypeError):
+        log.warning("Invalid UUID: %s", user_id)
+        return []
+
+    user_key = str(user_id)
+    cached_city_list = cities_cache.get(user_key)
+    if cached_city_list is not None:
+        return cached_city_list
+    generation = cities_cache_generation
 
+    async with _txn("Error fetching cities for user %s", user_id) as txn:
         # Query all cities associated with the given user_id, including both id and city
-        cities = (
-            session.query(UsersCities.id, UsersCities.city)
-            .filter_by(user_id=user_id)
-            .all()
+        result = await txn.session.execute(
+            select(UsersCities.id, UsersCities.city).where(
+                UsersCities.user_id == user_id
+            )
         )
+        cities = result.all()
 
-        if cities:
-            # Create a list of dictionaries with both id and city name
-            city_list = [{"id": str(city.id), "city": city.city} for city in cities]
-            print(f"Cities for user {user_id}: {city_list}")
-            return city_list
-        else:
-            print(f"No cities found for user {user_id}")
-            return []
-    except ValueError:
-        print(f"Invalid UUID: {user_id}")
+    if not txn.committed:
         return []
-    except Exception as e:
-        session.rollback()
-        print(f"Error fetching cities for user {user_id}: {e}")
-        return []
-    finally:
-        session.close()
+
+    # Create a list of dictionaries with both id and city name
+    city_list = [{"id": city.id, "city": city.city} for city in cities]
+    if cities_cache_generation == generation:
+        cities_cache[user_key] = city_list
+
+    if city_list:
+        log.debug("Cities for user %s: %s", user_id, city_list)
+    else:
+        log.debug("No cities found for user %s", user_id)
+    return city_list
+
+
+# Function to stream all cities (id and name) for a user, in batches
+async def iter_cities_for_user(user_id: str, batch_size: int = 1000):
+    """
+    Yield the user's cities one by one, holding at most one batch of rows
+
+    Unlike get_cities_for_user this neither builds the full list nor caches it.
+    Database errors are logged and re-raised, so a half-sent response is
+    aborted rather than ended as if the list were complete.
+    """
+
+    try:
+        # Ensure user_id is a valid UUID
+        uid = _as_uuid(user_id)
+    except (ValueError, TypeError):
+        log.warning("Invalid UUID: %s", user_id)
+        return
+
+    try:
+        async with get_sessionmaker().begin() as session:
+            # Rows are fetched from a server-side cursor, batch_size at a time
+            result = await session.stream(
+                select(UsersCities.id, UsersCities.city)
+                .where(UsersCities.user_id == uid)
+                .execution_options(yield_per=batch_size)
+            )
+            async for partition in result.partitions():
+                for city in partition:
+                    yield {"id": city.id, "city": city.city}
+    except Exception:
+        log.exception("Error streaming cities for user %s", user_id)
+        raise